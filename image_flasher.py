@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import sys
+import shutil
+import subprocess
 import pathlib
 import serial
 import logging
@@ -10,11 +14,27 @@ from typing import List
 from string import printable
 import tftpy
 import threading
+import queue
+import mmap
 import lzma
+import zlib
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 log = logging.getLogger(__name__)
 
+uboot_propmt = "=>"
+
+###########
+base_addr = 0x0
+mmc_device = 1
+mmc_part = 0
+mmc_block_size = 512
+# image chunks are loaded to this address of the board RAM
+load_addr = 0x48000000
+# generated u-boot script is loaded above the chunk RAM window
+script_addr = 0x58000000
+###########
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -39,6 +59,29 @@ def main():
         const="AUTO",
         help="Use external TFTP server or start our own")
 
+    parser.add_argument(
+        '--chunk-mb',
+        type=int,
+        default=20,
+        help='Size of one image chunk, in MiB')
+
+    parser.add_argument(
+        '--ram-window-mb',
+        type=int,
+        default=128,
+        help='Size of the board RAM window used to batch chunks, in MiB')
+
+    parser.add_argument(
+        '--crc',
+        action='store_true',
+        help='Verify CRC32 of every chunk on the board after TFTP transfer')
+
+    parser.add_argument(
+        '--script',
+        action='store_true',
+        help='Pre-split the image and flash it with one generated u-boot '
+             'script (requires mkimage and disk space for the whole image)')
+
     parser.add_argument(
         '--serverip',
         help='IP of the host that will be used TFTP transfer.')
@@ -50,6 +93,7 @@ def main():
     args = parser.parse_args()
 
     tftp_root = os.getcwd()
+    tftpsrv = None
 
     if args.tftp == "AUTO":
         log.info(f"Starting our TFTP server...")
@@ -65,34 +109,90 @@ def main():
     else:
         raise Exception("-t parameter is not external TFTP root.")
 
-    do_flash_image(args, tftp_root)
-
-    if args.tftp == "AUTO":
-        log.info("Stopping our TFTP server")
-        tftpsrv.stop_tftp_server()
-        TFTP_srv_thread.join()
+    try:
+        if args.script:
+            do_flash_image_script(args, tftp_root)
+        else:
+            do_flash_image(args, tftp_root, tftpsrv)
+    finally:
+        # the server must not outlive a failed run: a leftover atftpd
+        # child would keep port 69 bound and serve the stale TFTP root
+        if args.tftp == "AUTO":
+            log.info("Stopping our TFTP server")
+            tftpsrv.stop_tftp_server()
+            TFTP_srv_thread.join()
 
 
 class PYTFTPServer(object):
+    """TFTP server used in the AUTO mode.
+
+    Prefers the native 'atftpd' daemon when it is installed - tftpy is
+    pure Python, single-threaded and cannot saturate the link with large
+    block sizes. Falls back to the built-in tftpy server otherwise.
+    """
+
     def __init__(self, folder):
-        self.tftp_server = tftpy.TftpServer(folder)
+        self.folder = folder
+        self.chunks = {}
+        self.chunks_lock = threading.Lock()
+        self.chunk_fds = {}
+        self.atftpd = shutil.which("atftpd")
+        self.atftpd_proc = None
+        if not self.atftpd:
+            self.tftp_server = tftpy.TftpServer(
+                folder, dyn_file_func=self.get_chunk)
 
     def start_tftp_server(self):
-        # listen to all interfaces and port 69
-        self.tftp_server.listen()
+        if self.atftpd:
+            log.info("Using native atftpd server")
+            self.atftpd_proc = subprocess.Popen(
+                [self.atftpd, "--daemon", "--no-fork", "--logfile", "-",
+                 "--port", "69", self.folder])
+        else:
+            # listen to all interfaces and port 69
+            self.tftp_server.listen()
 
     def stop_tftp_server(self):
-        self.tftp_server.stop()
-
-
-def do_flash_image(args, tftp_root):
-
-    log.info(args.image)
-
-    conn = open_connection(args)
-
-    uboot_propmt = "=>"
-
+        for fd in self.chunk_fds.values():
+            os.close(fd)
+        if self.atftpd_proc:
+            self.atftpd_proc.terminate()
+            self.atftpd_proc.wait()
+        else:
+            self.tftp_server.stop()
+
+    def set_chunk(self, fname, data):
+        if self.atftpd:
+            # the native server reads from the TFTP root on disk; the
+            # file is opened once and rewritten in place for every chunk
+            fd = self.chunk_fds.get(fname)
+            if fd is None:
+                fd = os.open(os.path.join(self.folder, fname),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+                self.chunk_fds[fname] = fd
+            os.pwrite(fd, data, 0)
+            os.ftruncate(fd, len(data))
+        else:
+            # publish chunk in memory, so it never touches the disk
+            with self.chunks_lock:
+                self.chunks[fname] = data
+
+    def drop_chunks(self):
+        # release published buffers, e.g. views of a memory-mapped image
+        with self.chunks_lock:
+            self.chunks.clear()
+
+    def get_chunk(self, fname, raddress=None, rport=None):
+        # requests for anything but the published chunks fall back
+        # to the on-disk TFTP root
+        with self.chunks_lock:
+            data = self.chunks.get(fname)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+
+def prepare_uboot(args, conn):
     # Send 'CR', and check for one of the possible options:
     # - uboot_prompt appears, if u-boot console is already active
     # - u-boot is just starting, so we will get "Hit any key.."
@@ -103,31 +203,6 @@ def do_flash_image(args, tftp_root):
     conn_send(conn, "\r")
     conn_wait_for(conn, uboot_propmt)
 
-    image_size = os.path.getsize(args.image)
-
-    ###########
-    base_addr = 0x0
-    mmc_device = 1
-    mmc_part = 0
-    mmc_block_size = 512
-    ###########
-
-    chunk_filename = "chunk.bin"
-    chunk_size_in_bytes = 20*1024*1024
-
-    use_lzma = False
-
-    if str(args.image).endswith(".xz"):
-        use_lzma = True
-        f_lzma = lzma.open(args.image)
-        image_size = 0
-    else:
-        f_img = open(args.image, "rb")
-
-    bytes_sent = 0
-    block_start = base_addr // mmc_block_size
-    out_fullname = os.path.join(tftp_root, chunk_filename)
-
     if args.serverip:
         conn_send(conn, f"env set serverip {args.serverip}\r")
         conn_wait_for(conn, uboot_propmt)
@@ -136,49 +211,330 @@ def do_flash_image(args, tftp_root):
         conn_send(conn, f"env set ipaddr {args.ipaddr}\r")
         conn_wait_for(conn, uboot_propmt)
 
+    # ask the server for bigger TFTP blocks and a send window: with the
+    # default 512-byte blocks a 20 MiB chunk costs ~41000 ACK round-trips,
+    # with 1468-byte blocks and windowsize 16 it is only a few hundred;
+    # servers that do not support the options simply fall back to defaults
+    conn_send(conn, f"env set tftpblocksize 1468\r")
+    conn_wait_for(conn, uboot_propmt)
+    conn_send(conn, f"env set tftpwindowsize 16\r")
+    conn_wait_for(conn, uboot_propmt)
+
     # switch to the required MMC device/partition
     conn_send(conn, f"mmc dev {mmc_device} {mmc_part}\r")
     conn_wait_for(conn, uboot_propmt)
 
+
+def do_flash_image(args, tftp_root, tftpsrv=None):
+
+    log.info(args.image)
+
+    conn = open_connection(args)
+    prepare_uboot(args, conn)
+
+    image_size = os.path.getsize(args.image)
+
+    # two files are alternated, so the next chunk can be prepared while
+    # u-boot is still transferring and flashing the previous one
+    chunk_filenames = ["chunk_a.bin", "chunk_b.bin"]
+    chunk_size_in_bytes = args.chunk_mb*1024*1024
+
+    # adjacent non-zero chunks are batched into one RAM window, so the
+    # per-transfer u-boot command overhead is paid once per window
+    ram_window_bytes = max(args.ram_window_mb*1024*1024, chunk_size_in_bytes)
+
+    use_lzma = False
+    use_mmap = False
+
+    f_img = open(args.image, "rb")
+    if str(args.image).endswith(".lz4"):
+        # LZ4 decompresses several times faster than xz at a modestly
+        # worse ratio, so the chunk producer rarely stalls on CPU
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Exception(
+                "Flashing .lz4 images requires the 'lz4' python package.")
+        f_img = lz4.frame.LZ4FrameFile(f_img)
+        image_size = 0
+    elif str(args.image).endswith(".xz"):
+        use_lzma = True
+        # raw decompressor avoids the extra buffering layer and the fresh
+        # 20 MiB allocation that lzma.open().read() makes for every chunk
+        lzma_decompressor = lzma.LZMADecompressor()
+        lzma_read_size = 1024*1024
+        image_size = 0
+    elif image_size:
+        # plain image - map it into memory, so windows are served as
+        # zero-copy views of the page cache instead of read() copies
+        mm = mmap.mmap(f_img.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        use_mmap = True
+
+    bytes_sent = 0
+    block_start = base_addr // mmc_block_size
+    zero_run_start = block_start
+    zero_run_blocks = 0
+
+    # 'free_chunks' holds (name, buffer) pairs that u-boot is done with,
+    # 'ready_chunks' holds chunks prepared by the producer thread;
+    # the buffers are preallocated once and reused for the whole image,
+    # so no 20 MiB objects are allocated per chunk
+    # window buffers are only needed when the image is decompressed;
+    # a memory-mapped plain image is served from the map itself
+    free_chunks = queue.Queue()
+    for name in chunk_filenames:
+        free_chunks.put((name, None if use_mmap else
+                         bytearray(ram_window_bytes)))
+    ready_chunks = queue.Queue(maxsize=1)
+
+    # chunk files for the external TFTP server are opened once and kept
+    # open, so rewriting them costs no creat/close/inode work per window
+    chunk_fds = {}
+
+    def write_chunk_file(chunk_filename, data):
+        fd = chunk_fds.get(chunk_filename)
+        if fd is None:
+            fd = os.open(os.path.join(tftp_root, chunk_filename),
+                         os.O_RDWR | os.O_CREAT, 0o644)
+            chunk_fds[chunk_filename] = fd
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+
+    lzma_stream_end = False
+
+    def read_lzma_chunk(window_buf, offset):
+        # feed the decompressor until one chunk is produced at 'offset'
+        # or the compressed data ends, returns the number of bytes
+        nonlocal lzma_decompressor, lzma_stream_end
+        n = 0
+        while n < chunk_size_in_bytes and not lzma_stream_end:
+            if lzma_decompressor.eof:
+                # a valid .xz may concatenate several streams (pixz,
+                # 'cat a.xz b.xz') - continue with a fresh decompressor
+                # like lzma.open() does; trailing data that is not a
+                # compressed stream ends the image
+                compressed = (lzma_decompressor.unused_data
+                              or f_img.read(lzma_read_size))
+                if not compressed:
+                    lzma_stream_end = True
+                    break
+                lzma_decompressor = lzma.LZMADecompressor()
+                try:
+                    piece = lzma_decompressor.decompress(
+                        compressed, max_length=chunk_size_in_bytes - n)
+                except lzma.LZMAError:
+                    lzma_stream_end = True
+                    break
+            else:
+                if lzma_decompressor.needs_input:
+                    compressed = f_img.read(lzma_read_size)
+                    if not compressed:
+                        # the file ran out while the decompressor still
+                        # wants input - a truncated image must not be
+                        # flashed as if it ended here (lzma.open() raises
+                        # the same way)
+                        raise EOFError("Compressed file ended before the "
+                                       "end-of-stream marker was reached")
+                else:
+                    compressed = b""
+                piece = lzma_decompressor.decompress(
+                    compressed, max_length=chunk_size_in_bytes - n)
+            window_buf[offset + n:offset + n + len(piece)] = piece
+            n += len(piece)
+        return n
+
+    def produce_chunks():
+        # read and decompress the next chunks while u-boot is busy
+        # flashing the previous window; adjacent non-zero chunks are
+        # accumulated into one window, zero chunks end the batch and are
+        # only counted - the consumer turns them into 'mmc erase'
+        chunk_filename = None
+        window_buf = None
+        filled = 0
+
+        def flush_window():
+            nonlocal chunk_filename, window_buf, filled
+            if not filled:
+                return
+            data = memoryview(window_buf)[:filled]
+            # zlib.crc32 is a C single-pass, computed here so it overlaps
+            # with the board flashing the previous window
+            window_crc = zlib.crc32(data) if args.crc else 0
+            if tftpsrv:
+                # hand the window over to our own server; with the tftpy
+                # backend it is served straight from memory
+                tftpsrv.set_chunk(chunk_filename, data)
+            else:
+                write_chunk_file(chunk_filename, data)
+            ready_chunks.put(
+                (chunk_filename, window_buf, filled, window_crc, False))
+            chunk_filename = None
+            window_buf = None
+            filled = 0
+
+        while True:
+            if window_buf is None:
+                chunk_filename, window_buf = free_chunks.get()
+
+            if use_lzma:
+                n = read_lzma_chunk(window_buf, filled)
+            else:
+                n = f_img.readinto(
+                    memoryview(window_buf)[filled:filled + chunk_size_in_bytes])
+
+            if not n:
+                break
+
+            # count() scans the buffer in C and allocates nothing
+            if window_buf.count(0, filled, filled + n) == n:
+                flush_window()
+                ready_chunks.put((None, None, n, 0, True))
+                continue
+
+            filled += n
+            if filled + chunk_size_in_bytes > ram_window_bytes:
+                flush_window()
+
+        # EOF - flush the last (partial) window and wake up the consumer
+        # for the last time
+        flush_window()
+        if window_buf is not None:
+            free_chunks.put((chunk_filename, window_buf))
+        ready_chunks.put(None)
+
+    def produce_mmap_chunks():
+        # same batching as produce_chunks, but a window is published as a
+        # zero-copy view of the memory map - adjacent non-zero chunks are
+        # adjacent in the file, so a view covers the whole window
+        chunk_filename = None
+        window_start = 0
+        offset = 0
+
+        def flush_window(end):
+            nonlocal chunk_filename, window_start
+            if end == window_start:
+                return
+            data = memoryview(mm)[window_start:end]
+            window_crc = zlib.crc32(data) if args.crc else 0
+            if tftpsrv:
+                tftpsrv.set_chunk(chunk_filename, data)
+            else:
+                write_chunk_file(chunk_filename, data)
+            ready_chunks.put(
+                (chunk_filename, None, end - window_start, window_crc, False))
+            chunk_filename = None
+            window_start = end
+
+        while offset < image_size:
+            if chunk_filename is None:
+                chunk_filename, _ = free_chunks.get()
+
+            n = min(chunk_size_in_bytes, image_size - offset)
+            # one memcpy from the page cache, scanned with count() in C
+            if mm[offset:offset + n].count(0) == n:
+                flush_window(offset)
+                ready_chunks.put((None, None, n, 0, True))
+                window_start = offset + n
+            offset += n
+
+            if offset - window_start + chunk_size_in_bytes > ram_window_bytes:
+                flush_window(offset)
+
+        flush_window(offset)
+        ready_chunks.put(None)
+
+    # tftpy consults the on-disk root before dyn_file_func, so a stale
+    # chunk file left behind by a crashed run would silently shadow the
+    # in-memory chunks - drop such leftovers before serving anything
+    if tftpsrv and not tftpsrv.atftpd:
+        for name in chunk_filenames:
+            stale_fullname = os.path.join(tftp_root, name)
+            if os.path.exists(stale_fullname):
+                os.remove(stale_fullname)
+
+    def run_producer():
+        # a crashed producer must not leave the consumer blocked on the
+        # queue forever - deliver the exception instead of the chunk and
+        # let the main loop re-raise it
+        try:
+            if use_mmap:
+                produce_mmap_chunks()
+            else:
+                produce_chunks()
+        except Exception as e:
+            ready_chunks.put(e)
+
+    producer = threading.Thread(
+        name="Chunk producer thread", target=run_producer, daemon=True)
+    producer.start()
+
+    # hot-loop commands are prepared as bytes templates, so each iteration
+    # costs one C-level formatting instead of f-string + str.encode;
+    # tftp, the optional crc check and mmc write are chained with '&&'
+    # into one compound command - a single prompt round-trip per window
+    # instead of one per step
+    MMC_ERASE_FMT = b"mmc erase 0x%X 0x%X\r"
+    if args.crc:
+        FLASH_FMT = (f"tftp 0x{load_addr:X} %s"
+                     f" && crc32 -v 0x{load_addr:X} 0x%X 0x%08x"
+                     f" && mmc write 0x{load_addr:X} 0x%X 0x%X\r").encode()
+    else:
+        FLASH_FMT = (f"tftp 0x{load_addr:X} %s"
+                     f" && mmc write 0x{load_addr:X} 0x%X 0x%X\r").encode()
+
     # do in loop:
-    # - read X MB chunk from image file
-    # - save chunk to file in tftp root
+    # - take the next prepared chunk from the producer thread
     # - tell u-boot to 'tftp-and-emmc' chunk
     while True:
-        if use_lzma:
-            data = f_lzma.read(chunk_size_in_bytes)
-        else:
-            data = f_img.read(chunk_size_in_bytes)
-
-        if not data:
+        chunk = ready_chunks.get()
+        if chunk is None:
             break
+        if isinstance(chunk, Exception):
+            # the producer thread failed, surface its error here
+            raise chunk
+        chunk_filename, chunk_buf, chunk_size, chunk_crc, \
+            buffer_is_00_only = chunk
 
-        chunk_size_in_blocks = len(data) // mmc_block_size
-        if len(data) % mmc_block_size:
-            chunk_size_in_blocks += 1
-
-        buffer_is_00_only = True
-        for i in range(len(data)):
-            # check for zero only
-            if (data[i] != 0):
-                buffer_is_00_only = False
+        # round up to whole blocks without the extra modulo branch
+        chunk_size_in_blocks = -(-chunk_size // mmc_block_size)
 
         if buffer_is_00_only:
-            conn_send(conn, f"mw.b 0x48000000 0x00 0x{len(data):X}\r")
-            conn_wait_for(conn, uboot_propmt)
+            # do not write zeros to eMMC - remember where the run of zero
+            # blocks starts and let it grow, a single 'mmc erase' covering
+            # the whole run is much faster than writing the same zeros
+            if not zero_run_blocks:
+                zero_run_start = block_start
+            zero_run_blocks += chunk_size_in_blocks
         else:
-            # create chunk
-            f_out = open(out_fullname, "wb")
-            f_out.write(data)
-            f_out.close()
-
-            conn_send(conn, f"tftp 0x48000000 {chunk_filename}\r")
-            conn_wait_for(conn, uboot_propmt)
-
-        conn_send(conn, f"mmc write 0x48000000 0x{block_start:X} 0x{chunk_size_in_blocks:X}\r")
-        conn_wait_for(conn, uboot_propmt)
-
-        bytes_sent += len(data)
+            if zero_run_blocks:
+                conn.write(MMC_ERASE_FMT % (zero_run_start, zero_run_blocks))
+                rcv_str = conn_wait_for(conn, uboot_propmt)
+                if "blocks erased: OK" not in rcv_str:
+                    raise Exception(
+                        f"Erase of blocks at 0x{zero_run_start:X} failed")
+                zero_run_blocks = 0
+
+            if args.crc:
+                conn.write(FLASH_FMT % (chunk_filename.encode("ascii"),
+                                        chunk_size, chunk_crc,
+                                        block_start, chunk_size_in_blocks))
+            else:
+                conn.write(FLASH_FMT % (chunk_filename.encode("ascii"),
+                                        block_start, chunk_size_in_blocks))
+            # '&&' stops the chain on the first failed step, so the
+            # positive 'mmc write' confirmation proves the whole chain
+            rcv_str = conn_wait_for(conn, uboot_propmt)
+            if "blocks written: OK" not in rcv_str:
+                raise Exception(
+                    f"Flashing of chunk at block 0x{block_start:X} failed")
+
+            # u-boot is done with this chunk, give the name and the
+            # buffer back to the producer
+            free_chunks.put((chunk_filename, chunk_buf))
+
+        bytes_sent += chunk_size
         block_start += chunk_size_in_blocks
 
         if image_size:
@@ -188,14 +544,146 @@ def do_flash_image(args, tftp_root):
 
         print("===============================")
 
+    # image may end with a run of zero blocks - erase it now
+    if zero_run_blocks:
+        conn.write(MMC_ERASE_FMT % (zero_run_start, zero_run_blocks))
+        rcv_str = conn_wait_for(conn, uboot_propmt)
+        if "blocks erased: OK" not in rcv_str:
+            raise Exception(
+                f"Erase of blocks at 0x{zero_run_start:X} failed")
+
     # send "newline char" to start further output on the new line
     print("")
 
-    os.remove(out_fullname)
-    if use_lzma:
-        f_lzma.close()
+    producer.join()
+
+    for fd in chunk_fds.values():
+        os.close(fd)
+
+    # chunk files are not created at all for the fully-zero image
+    for name in chunk_filenames:
+        out_fullname = os.path.join(tftp_root, name)
+        if os.path.exists(out_fullname):
+            os.remove(out_fullname)
+    if use_mmap:
+        if tftpsrv:
+            # the server may still hold views of the map
+            tftpsrv.drop_chunks()
+        mm.close()
+    f_img.close()
+    conn.close()
+
+    log.info("Image was flashed successfully.")
+
+
+def do_flash_image_script(args, tftp_root):
+    """Flash the image with one generated u-boot script.
+
+    The whole command sequence is known in advance, so it is emitted
+    into a script executed on the board with a single 'source' command,
+    eliminating all per-chunk serial round-trips. The price is that all
+    chunks must be pre-split into the TFTP root up front, which needs
+    'mkimage' on the host and free disk space for the non-zero part of
+    the image.
+    """
+
+    log.info(args.image)
+
+    mkimage = shutil.which("mkimage")
+    if not mkimage:
+        raise Exception("--script requires the 'mkimage' tool "
+                        "(u-boot-tools package).")
+
+    chunk_size_in_bytes = args.chunk_mb*1024*1024
+
+    if str(args.image).endswith(".lz4"):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Exception(
+                "Flashing .lz4 images requires the 'lz4' python package.")
+        f_img = lz4.frame.LZ4FrameFile(args.image)
+    elif str(args.image).endswith(".xz"):
+        f_img = lzma.open(args.image)
     else:
-        f_img.close()
+        f_img = open(args.image, "rb")
+
+    # pre-pass: split the image into chunk files and build the command
+    # sequence; '|| echo FLASH_FAILED' marks any failed step in the
+    # console output, since 'source' does not stop on errors
+    commands = [f"mmc dev {mmc_device} {mmc_part}"]
+    chunk_files = []
+    block_start = base_addr // mmc_block_size
+    zero_run_start = block_start
+    zero_run_blocks = 0
+
+    log.info("Splitting image into chunks...")
+    while True:
+        data = f_img.read(chunk_size_in_bytes)
+        if not data:
+            break
+
+        chunk_size_in_blocks = -(-len(data) // mmc_block_size)
+
+        if not data.translate(None, b"\x00"):
+            if not zero_run_blocks:
+                zero_run_start = block_start
+            zero_run_blocks += chunk_size_in_blocks
+        else:
+            if zero_run_blocks:
+                commands.append(
+                    f"mmc erase 0x{zero_run_start:X} 0x{zero_run_blocks:X}"
+                    f" || echo FLASH_FAILED")
+                zero_run_blocks = 0
+
+            chunk_filename = f"chunk_{len(chunk_files):04d}.bin"
+            with open(os.path.join(tftp_root, chunk_filename), "wb") as f_out:
+                f_out.write(data)
+            chunk_files.append(chunk_filename)
+
+            command = f"tftp 0x{load_addr:X} {chunk_filename}"
+            if args.crc:
+                command += (f" && crc32 -v 0x{load_addr:X} 0x{len(data):X}"
+                            f" 0x{zlib.crc32(data):08x}")
+            command += (f" && mmc write 0x{load_addr:X} 0x{block_start:X}"
+                        f" 0x{chunk_size_in_blocks:X}")
+            commands.append(command + " || echo FLASH_FAILED")
+
+        block_start += chunk_size_in_blocks
+
+    if zero_run_blocks:
+        commands.append(
+            f"mmc erase 0x{zero_run_start:X} 0x{zero_run_blocks:X}"
+            f" || echo FLASH_FAILED")
+
+    commands.append("echo FLASH_DONE")
+
+    flash_cmd = os.path.join(tftp_root, "flash.cmd")
+    flash_scr = os.path.join(tftp_root, "flash.scr")
+    with open(flash_cmd, "w") as f_out:
+        f_out.write("\n".join(commands) + "\n")
+
+    subprocess.run(
+        [mkimage, "-A", "arm", "-T", "script", "-C", "none",
+         "-n", "flash", "-d", flash_cmd, flash_scr],
+        check=True, stdout=subprocess.DEVNULL)
+
+    log.info(f"Executing generated script with {len(commands)} commands...")
+
+    conn = open_connection(args)
+    prepare_uboot(args, conn)
+
+    conn_send(conn, f"tftp 0x{script_addr:X} flash.scr\r")
+    conn_wait_for(conn, uboot_propmt)
+
+    conn_send(conn, f"source 0x{script_addr:X}\r")
+    rcv_str = conn_wait_for(conn, uboot_propmt)
+    if "FLASH_FAILED" in rcv_str or "FLASH_DONE" not in rcv_str:
+        raise Exception("Flashing script failed on the board.")
+
+    for name in chunk_files + ["flash.cmd", "flash.scr"]:
+        os.remove(os.path.join(tftp_root, name))
+    f_img.close()
     conn.close()
 
     log.info("Image was flashed successfully.")
@@ -214,33 +702,99 @@ def open_connection(args):
         conn.close()
     conn.open()
 
+    # grow the driver receive buffer where the platform allows it
+    # (Windows only in pyserial), so verbose u-boot output does not
+    # overrun the default 4 KiB buffer between our reads
+    if hasattr(conn, "set_buffer_size"):
+        try:
+            conn.set_buffer_size(rx_size=1 << 20, tx_size=1 << 16)
+        except Exception as e:
+            log.warning(f"Can not set serial buffer size: {e}")
+
+    # FTDI adapters buffer received bytes for 16 ms by default, which is
+    # paid on every prompt round-trip; ask the driver for 1 ms instead
+    try:
+        conn.set_low_latency_mode(True)
+    except Exception as e:
+        log.warning(f"Can not enable low latency mode: {e}")
+
+    latency_timer = (f"/sys/bus/usb-serial/devices/"
+                     f"{os.path.basename(dev_name)}/latency_timer")
+    if os.path.exists(latency_timer):
+        try:
+            with open(latency_timer, "w") as f:
+                f.write("1")
+        except PermissionError:
+            log.warning(
+                f"No permission to write {latency_timer}, command "
+                f"round-trips will be slower. Run with sudo or allow "
+                f"write access with a udev rule.")
+
     return conn
 
 
+# everything not printable (except backspace) is dropped before the
+# device output reaches the terminal
+NON_PRINTABLE_BYTES = bytes(b for b in range(256)
+                            if chr(b) not in printable and b != 0x08)
+
+
+def conn_print(data: bytes):
+    # echo the device output, dropping non-printable garbage; the data
+    # stays in the stdout buffer until a line end arrives, so echoing
+    # costs a write() syscall per line instead of one per character
+    sys.stdout.buffer.write(data.translate(None, NON_PRINTABLE_BYTES))
+    if b"\n" in data or b"\r" in data:
+        sys.stdout.buffer.flush()
+
+
 def conn_wait_for(conn, expect: str):
-    rcv_str = ""
-    while expect not in rcv_str:
-        data = conn.read(1)
-        if not data:
-            raise TimeoutError(f"Timeout waiting for `{expect}` from the device")
-        rcv_char = chr(data[0])
-        if rcv_char in printable or rcv_char == '\b':
-            print(rcv_char, end='', flush=True)
-        rcv_str += rcv_char
+    expect_bytes = expect.encode("ascii")
+    tail_len = len(expect_bytes) - 1
+    rcv_buf = bytearray()
+    try:
+        # the timeout is applied per read, so long operations are fine as
+        # long as the device keeps printing something every 20 seconds
+        while True:
+            # drain everything the driver has already buffered in one read
+            data = conn.read(max(1, conn.in_waiting))
+            if not data:
+                raise TimeoutError(f"Timeout waiting for `{expect}` from the device")
+            conn_print(data)
+            rcv_buf.extend(data)
+            # search only the new data and the seam with the previous read
+            scan_from = max(0, len(rcv_buf) - len(data) - tail_len)
+            if rcv_buf.find(expect_bytes, scan_from) != -1:
+                # let the caller inspect the answer, e.g. for error messages
+                return rcv_buf.decode("ascii", errors="replace")
+    finally:
+        # nothing stays buffered after the prompt (or a timeout)
+        sys.stdout.buffer.flush()
 
 
 def conn_wait_for_any(conn, expect: List[str]):
-    rcv_str = ""
-    # stay in the read loop until any of expected string is received
-    # in other words - all expected substrings are not in received buffer
-    while all([x not in rcv_str for x in expect]):
-        data = conn.read(1)
-        if not data:
-            raise TimeoutError(f"Timeout waiting for `{expect}` from the device")
-        rcv_char = chr(data[0])
-        if rcv_char in printable or rcv_char == '\b':
-            print(rcv_char, end='', flush=True)
-        rcv_str += rcv_char
+    expect_bytes = [x.encode("ascii") for x in expect]
+    # a pattern can only match inside the newly received data or across
+    # the seam with the previous read, so it is enough to re-scan the new
+    # data plus a tail of (longest pattern - 1) bytes - not the whole
+    # history of the received output
+    tail_len = max(len(x) for x in expect_bytes) - 1
+    tail = b""
+    try:
+        # stay in the read loop until any of expected strings is received
+        while True:
+            # drain everything the driver has already buffered in one read
+            data = conn.read(max(1, conn.in_waiting))
+            if not data:
+                raise TimeoutError(f"Timeout waiting for `{expect}` from the device")
+            conn_print(data)
+            window = tail + data
+            if any(x in window for x in expect_bytes):
+                return
+            tail = window[-tail_len:] if tail_len else b""
+    finally:
+        # nothing stays buffered after the match (or a timeout)
+        sys.stdout.buffer.flush()
 
 
 def conn_send(conn, data):